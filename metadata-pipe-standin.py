@@ -0,0 +1,264 @@
+#!/usr/bin/env /usr/bin/python3
+#
+# Stand-in for shairport-sync's metadata pipe, for testing --backend pipe
+# without a sender.
+#
+#   python3 metadata-pipe-standin.py /tmp/shairport-sync-metadata
+#       writes a scripted session into the FIFO in small split chunks, run
+#       shairport-display-qt.py --backend pipe against the same FIFO
+#
+#   python3 metadata-pipe-standin.py --check
+#       starts the display headless with --backend pipe --record on a
+#       temporary FIFO, writes the session into it at several chunk sizes,
+#       reopening the FIFO each time, and checks what reaches
+#       handlePropertyChanges, the trace and the display
+#
+# The session includes the awkward cases: an item with corrupt base64, art
+# that is not an image, a track without art (empty PICT), a malformed
+# progress string and a muted volume (pvol -144).
+
+import argparse
+import base64
+import importlib.util
+import io
+import json
+import logging
+import os
+import stat
+import sys
+import tempfile
+import threading
+import time
+
+from PIL import Image
+
+CLIENT = "Stand-in iPhone"
+ARTIST = "Stand-in Artist"
+ALBUM = "Stand-in Album"
+LENGTH_MS = 215000
+PROGRESS = "1000/45100/9482000"
+CHUNKS = (1, 7, 37, 4096, 1 << 20)
+
+
+def item(kind, code, payload=b"", encoded=None):
+    if encoded is None and payload:
+        encoded = base64.encodebytes(payload)
+    text = "<item><type>%s</type><code>%s</code><length>%d</length>" % (
+        kind.encode().hex(),
+        code.encode().hex(),
+        len(payload or encoded or b""),
+    )
+    if encoded:
+        text += '\n<data encoding="base64">\n' + encoded.decode() + "</data>"
+    return (text + "</item>\n").encode()
+
+
+def cover_art():
+    f = io.BytesIO()
+    Image.new("RGB", (300, 300), (20, 90, 200)).save(f, "JPEG")
+    return f.getvalue()
+
+
+def title(run):
+    return "Stand-in Song %d" % run
+
+
+def session(art, run=0):
+    return [
+        item("ssnc", "snam", CLIENT.encode()),
+        item("ssnc", "pbeg"),
+        item("ssnc", "pvol", b"-144.00,-96.00,-96.00,0.00"),
+        item("ssnc", "mdst", b"1234"),
+        item("core", "minm", title(run).encode()),
+        item("core", "asar", ARTIST.encode()),
+        item("core", "asal", ALBUM.encode()),
+        item("core", "astm", LENGTH_MS.to_bytes(4, "big")),
+        item("core", "asdk", b"\x00"),
+        item("ssnc", "mden", b"1234"),
+        # truncated base64, has to be skipped without losing the stream
+        item("ssnc", "pcst"),
+        item("ssnc", "PICT", encoded=b"QUJDR"),
+        item("ssnc", "pcen"),
+        # valid base64 that is not an image
+        item("ssnc", "pcst"),
+        item("ssnc", "PICT", art[: len(art) // 8]),
+        item("ssnc", "pcen"),
+        item("ssnc", "pcst"),
+        item("ssnc", "PICT"),
+        item("ssnc", "pcen"),
+        item("ssnc", "pcst"),
+        item("ssnc", "PICT", art),
+        item("ssnc", "pcen"),
+        item("ssnc", "prgr", b"garbage"),
+        item("ssnc", "prgr", PROGRESS.encode()),
+        item("ssnc", "pfls"),
+        item("ssnc", "pend"),
+    ]
+
+
+def expected(art, run=0):
+    metadata = {
+        "xesam:title": title(run),
+        "xesam:artist": [ARTIST],
+        "xesam:album": ALBUM,
+        "mpris:length": LENGTH_MS * 1000,
+        "sps:songdatakind": 0,
+    }
+    return [
+        {"ClientName": CLIENT},
+        {"PlayerState": "Playing"},
+        {"AirplayVolume": -30.0},
+        {"Metadata": metadata},
+        {"Metadata": dict(metadata, **{"mpris:artUrl": b""})},
+        {"Metadata": dict(metadata, **{"mpris:artUrl": art})},
+        {"ProgressString": PROGRESS},
+        {"PlayerState": "Paused"},
+        {"PlayerState": "Stopped"},
+    ]
+
+
+def load_display():
+    path = os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), "shairport-display-qt.py"
+    )
+    spec = importlib.util.spec_from_file_location("shairport_display", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module, path
+
+
+class Errors(logging.Handler):
+    def __init__(self):
+        super().__init__(logging.ERROR)
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+
+def check():
+    os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+    display, path = load_display()
+    from PyQt5.QtCore import QTimer
+
+    art = cover_art()
+    want = [event for run in range(len(CHUNKS)) for event in expected(art, run)]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        fifo = os.path.join(tmp, "metadata")
+        trace = os.path.join(tmp, "check.trace")
+        os.mkfifo(fifo)
+
+        args = display.parse_args(
+            ["--backend", "pipe", "--metadata-pipe", fifo]
+            + ["--config", "desktop", "--record", trace]
+        )
+        client = display.ShairportSyncClient([path], args)
+        client.handler.setLevel(logging.WARNING)
+        errors = Errors()
+        client.log.addHandler(errors)
+
+        events = []
+        handle = client.handlePropertyChanges
+
+        def collect(interface, data):
+            events.append(data)
+            handle(interface, data)
+
+        client.handlePropertyChanges = collect
+
+        def writer():
+            for run, chunk in enumerate(CHUNKS):
+                stream = b"".join(session(art, run))
+                with open(fifo, "wb", buffering=0) as f:
+                    for i in range(0, len(stream), chunk):
+                        f.write(stream[i : i + chunk])
+                # let the reader see EOF and reopen the FIFO
+                time.sleep(0.2)
+
+        thread = threading.Thread(target=writer, daemon=True)
+        thread.start()
+        deadline = time.monotonic() + 60
+
+        def done():
+            if len(events) >= len(want) or time.monotonic() > deadline:
+                client.quit()
+
+        timer = QTimer()
+        timer.timeout.connect(done)
+        timer.start(100)
+        client.exec_()
+
+        failed = False
+        if events != want:
+            failed = True
+            print("unexpected events, got %d of %d:" % (len(events), len(want)))
+            for event in events:
+                print("  ", {k: display.loggable(v) for k, v in event.items()})
+
+        for record in errors.records:
+            failed = True
+            print("logged error: %s" % record.getMessage())
+
+        if client.length != round((9482000 - 1000) / 44100):
+            failed = True
+            print("progress not applied, length %d" % client.length)
+
+        with open(trace) as f:
+            urls = [
+                entry["d"]["Metadata"].get("mpris:artUrl")
+                for entry in map(json.loads, f)
+                if "Metadata" in entry.get("d", {})
+            ]
+        for run in range(len(CHUNKS)):
+            empty, image = urls[run * 3 + 1], urls[run * 3 + 2]
+            if empty != "" or not image.startswith(display.TRACE_ART_SCHEME):
+                failed = True
+                print("run %d: art recorded as %r, %r" % (run, empty, image))
+
+    print("chunks %s: %s" % (", ".join(map(str, CHUNKS)), "FAILED" if failed else "ok"))
+    return 1 if failed else 0
+
+
+def write(path, chunk, delay, hold):
+    if not os.path.exists(path):
+        os.mkfifo(path)
+    elif not stat.S_ISFIFO(os.stat(path).st_mode):
+        print("'%s' is not a FIFO" % path)
+        return 1
+
+    items = session(cover_art())
+    with open(path, "wb", buffering=0) as f:
+        stream = b"".join(items[:-2])
+        for i in range(0, len(stream), chunk):
+            f.write(stream[i : i + chunk])
+            time.sleep(delay)
+        # leave the track showing before pausing and stopping
+        time.sleep(hold)
+        for last in items[-2:]:
+            f.write(last)
+            time.sleep(hold / 2)
+    return 0
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        description="shairport-sync metadata pipe stand-in"
+    )
+    parser.add_argument("pipe", nargs="?", default="/tmp/shairport-sync-metadata")
+    parser.add_argument("--check", action="store_true", help="run the checks and exit")
+    parser.add_argument(
+        "--chunk", type=int, default=37, help="bytes per write (default 37)"
+    )
+    parser.add_argument(
+        "--delay", type=float, default=0.001, help="seconds between writes"
+    )
+    parser.add_argument(
+        "--hold", type=float, default=5.0, help="seconds to show the track"
+    )
+    args = parser.parse_args()
+
+    if args.check:
+        sys.exit(check())
+    sys.exit(write(args.pipe, args.chunk, args.delay, args.hold))
@@ -9,10 +9,11 @@ from PyQt5.QtWidgets import (
     QProgressBar,
     QDesktopWidget,
     QGraphicsDropShadowEffect,
+    QVBoxLayout,
 )
 from PyQt5 import uic
 
-from PyQt5.QtCore import QTimer, Qt, QSize
+from PyQt5.QtCore import QTimer, Qt, QSize, QObject, pyqtSignal
 from PyQt5.QtGui import (
     QPixmap,
     QFont,
@@ -20,27 +21,934 @@ from PyQt5.QtGui import (
     QColor,
     QIcon,
     QPainter,
+    QImage,
 )
 
 from PIL import Image
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 import dbus
 import dbus.mainloop.glib
 import datetime
+import io
+import math
 import signal
 import sys
 import os
 import logging
 import colorsys
 import argparse
+import binascii
+import re
+import hashlib
+import json
+import queue
+import random
+import shutil
+import sqlite3
+import threading
+import time
 
 # Art dominant color gradient -- 90% brightness to 20% brightnessd
 GRADIENT_TOP = 0.9
 GRADIENT_BOTTOM = 0.2
 
+# shairport-sync pipe backend output: 44.1kHz, 16 bit little endian, stereo
+PCM_RATE = 44100
+PCM_CHANNELS = 2
+PCM_BYTES = 2
+
+# fraction of a spectrum bar left after one second without louder audio
+SPECTRUM_FALLOFF = 0.03
+
+# Trace files written by --record: one compact JSON object per line
+TRACE_VERSION = 1
+TRACE_ART_SCHEME = "trace-art://"
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Shairport Sync Display")
+    parser.add_argument(
+        "--config",
+        choices=["desktop", "raspberrypiofficial7inchscreen"],
+        default="raspberrypiofficial7inchscreen",
+    )
+    parser.add_argument(
+        "--backend",
+        choices=["dbus", "pipe"],
+        default="dbus",
+        help="where to get metadata from: D-Bus or the metadata pipe (default dbus)",
+    )
+    parser.add_argument(
+        "--metadata-pipe",
+        metavar="PIPE",
+        default="/tmp/shairport-sync-metadata",
+        help="shairport-sync metadata pipe used by --backend pipe",
+    )
+    parser.add_argument(
+        "--record",
+        metavar="TRACE",
+        help="write every PropertiesChanged payload to TRACE (art goes to TRACE.art/)",
+    )
+    parser.add_argument(
+        "--replay",
+        metavar="TRACE",
+        help="replay a recorded trace headless instead of listening on D-Bus",
+    )
+    parser.add_argument(
+        "--replay-speed",
+        type=float,
+        default=1.0,
+        help="replay speed multiplier, 0 replays as fast as possible (default 1)",
+    )
+    parser.add_argument(
+        "--replay-loops",
+        type=int,
+        default=1,
+        help="number of times to replay the trace, for soak testing (default 1)",
+    )
+    parser.add_argument(
+        "--history",
+        metavar="DB",
+        help="keep a play history in the SQLite database DB",
+    )
+    parser.add_argument(
+        "--history-flush",
+        type=float,
+        default=60.0,
+        help="seconds between play history writes (default 60)",
+    )
+    parser.add_argument(
+        "--history-bench",
+        type=int,
+        metavar="N",
+        help="benchmark the play history with N plays in a scratch database and exit",
+    )
+    parser.add_argument(
+        "--spectrum",
+        metavar="PIPE",
+        help="show a spectrum under the progress bar, fed from a PCM FIFO",
+    )
+    parser.add_argument(
+        "--spectrum-bands",
+        type=int,
+        default=24,
+        help="number of spectrum bars (default 24)",
+    )
+    parser.add_argument(
+        "--spectrum-fps",
+        type=int,
+        default=25,
+        help="maximum spectrum repaints per second (default 25)",
+    )
+    parser.add_argument(
+        "--spectrum-bench",
+        type=float,
+        metavar="SECONDS",
+        help="measure spectrum CPU cost on SECONDS of generated PCM and exit",
+    )
+    return parser.parse_args(argv)
+
+
+def file_digest(path):
+    with open(path, "rb") as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+def art_digest(art):
+    # art is a file path, or the image itself from the metadata pipe
+    if isinstance(art, bytes):
+        return hashlib.sha1(art).hexdigest()
+    return file_digest(art)
+
+
+def art_extension(data):
+    if data.startswith(b"\x89PNG"):
+        return ".png"
+    return ".jpg"
+
+
+def loggable(value):
+    if isinstance(value, bytes):
+        return "<%d bytes>" % len(value)
+    return value
+
+
+def dbus_to_native(value):
+    # dbus.Boolean is an int subclass, so it has to be checked first
+    if isinstance(value, dbus.Boolean):
+        return bool(value)
+    if isinstance(value, dict):
+        return {str(k): dbus_to_native(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [dbus_to_native(v) for v in value]
+    if isinstance(value, str):
+        return str(value)
+    if isinstance(value, int):
+        return int(value)
+    if isinstance(value, float):
+        return float(value)
+    return value
+
+
+class TraceRecorder:
+    """Appends PropertiesChanged payloads to a timestamped JSON lines trace"""
+
+    def __init__(self, path, log):
+        self.log = log
+        self.path = path
+        self.artdir = path + ".art"
+        self.artcache = {}
+        os.makedirs(self.artdir, exist_ok=True)
+        self.file = open(path, "w", buffering=1)
+        self.start = time.monotonic()
+        self._write(
+            {"trace": TRACE_VERSION, "started": datetime.datetime.now().isoformat()}
+        )
+        self.log.info("recording trace to '%s'", path)
+
+    def _write(self, entry):
+        self.file.write(json.dumps(entry, separators=(",", ":")) + "\n")
+
+    def _store_art(self, url):
+        if isinstance(url, bytes):
+            if not url:
+                return ""
+            name = art_digest(url) + art_extension(url)
+            if not os.path.exists(os.path.join(self.artdir, name)):
+                with open(os.path.join(self.artdir, name), "wb") as f:
+                    f.write(url)
+            return TRACE_ART_SCHEME + name
+
+        path = url.split("://")[-1]
+        try:
+            st = os.stat(path)
+        except OSError:
+            self.log.warning("art file '%s' is missing, not recorded", path)
+            return url
+        key = (path, st.st_mtime_ns, st.st_size)
+        if key not in self.artcache:
+            name = file_digest(path) + os.path.splitext(path)[1]
+            if not os.path.exists(os.path.join(self.artdir, name)):
+                shutil.copyfile(path, os.path.join(self.artdir, name))
+            self.artcache[key] = name
+        return TRACE_ART_SCHEME + self.artcache[key]
+
+    def record(self, interface, data):
+        data = dbus_to_native(data)
+        metadata = data.get("Metadata")
+        if metadata:
+            url = metadata.get("mpris:artUrl")
+            # art from the metadata pipe is bytes, empty when a track has none
+            if isinstance(url, bytes) or url:
+                metadata["mpris:artUrl"] = self._store_art(url)
+        self._write(
+            {
+                "t": round(time.monotonic() - self.start, 4),
+                "i": str(interface),
+                "d": data,
+            }
+        )
+
+    def close(self):
+        self.file.close()
+
+
+class TraceReplayer:
+    """Feeds a recorded trace back into handlePropertyChanges and times it"""
+
+    def __init__(self, client, path, speed=1.0, loops=1):
+        self.client = client
+        self.log = client.log
+        self.speed = speed
+        self.loops = loops
+        self.artdir = os.path.abspath(path + ".art")
+        self.events = []
+        self.latency = {}
+        self.failures = {}
+
+        with open(path, "r") as f:
+            for line in f:
+                entry = json.loads(line)
+                if "trace" in entry:
+                    if entry["trace"] != TRACE_VERSION:
+                        raise ValueError(
+                            "unsupported trace version %s" % entry["trace"]
+                        )
+                    continue
+                self._restore_art(entry["d"])
+                self.events.append(entry)
+
+        self.log.info("loaded %d events from '%s'", len(self.events), path)
+
+    def _restore_art(self, data):
+        metadata = data.get("Metadata")
+        if metadata:
+            url = metadata.get("mpris:artUrl", "")
+            if url.startswith(TRACE_ART_SCHEME):
+                name = url[len(TRACE_ART_SCHEME) :]
+                metadata["mpris:artUrl"] = "file://" + os.path.join(self.artdir, name)
+
+    def start(self):
+        self.index = 0
+        self.loop = 0
+        self.t0 = time.monotonic()
+        QTimer.singleShot(0, self._next)
+
+    def _next(self):
+        if self.index >= len(self.events):
+            self.loop += 1
+            if self.loop >= self.loops:
+                self.report()
+                self.client.quit()
+                return
+            self.index = 0
+            self.t0 = time.monotonic()
+
+        entry = self.events[self.index]
+        # copy, handlers are allowed to keep references to the payload
+        data = json.loads(json.dumps(entry["d"]))
+        kind = "+".join(sorted(data))
+        begin = time.perf_counter()
+        try:
+            self.client.handlePropertyChanges(entry["i"], data)
+        except Exception:
+            # an exception escaping a Qt slot aborts the process, keep going
+            # so the report still comes out
+            self.log.exception("event %d (%s) failed", self.index, kind)
+            self.failures[kind] = self.failures.get(kind, 0) + 1
+        elapsed = time.perf_counter() - begin
+        self.latency.setdefault(kind, []).append(elapsed)
+
+        self.index += 1
+        delay = 0
+        if self.speed > 0 and self.index < len(self.events):
+            # relative to the first event, idle time before it is skipped
+            offset = self.events[self.index]["t"] - self.events[0]["t"]
+            target = self.t0 + offset / self.speed
+            delay = max(0, int((target - time.monotonic()) * 1000))
+        QTimer.singleShot(delay, self._next)
+
+    def report(self):
+        self.log.info("replay finished, handler latency per event kind (ms):")
+        for kind in sorted(self.latency):
+            samples = sorted(self.latency[kind])
+            count = len(samples)
+            self.log.info(
+                "%-40s n=%-6d failed=%-4d mean=%8.3f p50=%8.3f p95=%8.3f max=%8.3f",
+                kind,
+                count,
+                self.failures.get(kind, 0),
+                sum(samples) / count * 1000,
+                samples[count // 2] * 1000,
+                samples[min(count - 1, int(count * 0.95))] * 1000,
+                samples[-1] * 1000,
+            )
+
+
+class PlayHistory:
+    """Play history in SQLite, written in batches from a background thread
+
+    Plays are queued by add() and written in one transaction when the flush
+    interval has passed, when batch_size plays are pending, or on close(), so
+    the SD card sees a few writes an hour instead of one per event.
+    """
+
+    COLUMNS = (
+        "started",
+        "ended",
+        "played",
+        "title",
+        "artist",
+        "album",
+        "length",
+        "client",
+        "art",
+    )
+
+    def __init__(self, path, log, flush_interval=60.0, batch_size=256):
+        self.path = path
+        self.log = log
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.queue = queue.Queue()
+        self.reader = None
+
+        db = self._connect()
+        db.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS plays (
+                id INTEGER PRIMARY KEY,
+                started REAL NOT NULL,
+                ended REAL NOT NULL,
+                played REAL NOT NULL,
+                title TEXT NOT NULL,
+                artist TEXT NOT NULL,
+                album TEXT NOT NULL,
+                length INTEGER NOT NULL,
+                client TEXT NOT NULL,
+                art TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS plays_started ON plays (started);
+            CREATE INDEX IF NOT EXISTS plays_artist ON plays (artist, started, played);
+            """
+        )
+        db.close()
+
+        self.thread = threading.Thread(
+            target=self._writer, name="play-history", daemon=True
+        )
+        self.thread.start()
+        self.log.info("play history in '%s'", path)
+
+    def _connect(self):
+        db = sqlite3.connect(self.path)
+        db.execute("PRAGMA journal_mode=WAL")
+        # with WAL, NORMAL only syncs at checkpoints
+        db.execute("PRAGMA synchronous=NORMAL")
+        return db
+
+    def _write(self, db, pending):
+        if not pending:
+            return
+        with db:
+            db.executemany(
+                "INSERT INTO plays (%s) VALUES (%s)"
+                % (", ".join(self.COLUMNS), ", ".join("?" * len(self.COLUMNS))),
+                [tuple(play[c] for c in self.COLUMNS) for play in pending],
+            )
+        self.log.debug("wrote %d plays to history", len(pending))
+        pending.clear()
+
+    def _writer(self):
+        db = self._connect()
+        pending = []
+        deadline = None
+        while True:
+            timeout = None if deadline is None else max(0, deadline - time.monotonic())
+            try:
+                item = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                item = False
+
+            if isinstance(item, dict):
+                pending.append(item)
+                if deadline is None:
+                    deadline = time.monotonic() + self.flush_interval
+                if len(pending) < self.batch_size:
+                    continue
+
+            try:
+                self._write(db, pending)
+            except sqlite3.Error as e:
+                self.log.warning("play history write failed: %s", e)
+            deadline = None
+
+            if isinstance(item, threading.Event):
+                item.set()
+            elif item is None:
+                break
+        db.close()
+
+    def add(self, play):
+        self.queue.put(dict(play))
+
+    def flush(self):
+        done = threading.Event()
+        self.queue.put(done)
+        done.wait()
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        if self.reader is not None:
+            self.reader.close()
+            self.reader = None
+
+    def _query(self, sql, params=()):
+        # queries come from the caller's thread, WAL lets them run
+        # alongside the writer. Plays still queued are not visible.
+        if self.reader is None:
+            self.reader = sqlite3.connect(self.path)
+            self.reader.row_factory = sqlite3.Row
+        return [dict(row) for row in self.reader.execute(sql, params)]
+
+    def recent(self, limit=20, artist=None):
+        if artist is None:
+            return self._query(
+                "SELECT * FROM plays ORDER BY started DESC LIMIT ?", (limit,)
+            )
+        return self._query(
+            "SELECT * FROM plays WHERE artist = ? ORDER BY started DESC LIMIT ?",
+            (artist, limit),
+        )
+
+    def stats(self, since=0, limit=10):
+        totals = self._query(
+            "SELECT COUNT(*) AS plays, COALESCE(SUM(played), 0) AS played "
+            "FROM plays WHERE started >= ?",
+            (since,),
+        )[0]
+        totals["artists"] = self._query(
+            "SELECT artist, COUNT(*) AS plays, SUM(played) AS played FROM plays "
+            "WHERE started >= ? GROUP BY artist ORDER BY plays DESC LIMIT ?",
+            (since, limit),
+        )
+        return totals
+
+
+def benchmark_history(count):
+    log = logging.getLogger("shairport-display")
+    path = "/tmp/shairport-display-bench-%d.db" % os.getpid()
+    history = PlayHistory(path, log, flush_interval=3600, batch_size=1000)
+    artists = ["Artist %d" % n for n in range(max(1, count // 20))]
+    now = time.time() - count * 240
+
+    begin = time.perf_counter()
+    for n in range(count):
+        history.add(
+            {
+                "started": now + n * 240,
+                "ended": now + n * 240 + 200,
+                "played": 200.0,
+                "title": "Title %d" % n,
+                "artist": random.choice(artists),
+                "album": "Album %d" % (n // 12),
+                "length": 200,
+                "client": "bench",
+                "art": "%040x" % n,
+            }
+        )
+    queued = time.perf_counter() - begin
+    history.flush()
+    written = time.perf_counter() - begin
+
+    def timed(fn, *args):
+        runs = 20
+        begin = time.perf_counter()
+        for _ in range(runs):
+            fn(*args)
+        return (time.perf_counter() - begin) / runs * 1000
+
+    print("plays:                %d" % count)
+    print("add() per play:       %.2f us" % (queued / count * 1e6))
+    print("insert per play:      %.2f us" % (written / count * 1e6))
+    print("recent(20):           %.3f ms" % timed(history.recent, 20))
+    print("recent(20, artist):   %.3f ms" % timed(history.recent, 20, artists[0]))
+    print(
+        "stats(last 7 days):   %.3f ms" % timed(history.stats, time.time() - 7 * 86400)
+    )
+    print("stats(all time):      %.3f ms" % timed(history.stats))
+
+    history.close()
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+
+
+class SpectrumAnalyser:
+    """Windowed FFT of a PCM block, summed into log spaced bands
+
+    All buffers are allocated once, analyse() only allocates the FFT output.
+    """
+
+    def __init__(self, bands=24, block=2048, low=50.0, high=16000.0, floor=-70.0):
+        self.block = block
+        self.floor = floor
+        self.mono = numpy.zeros(block, dtype=numpy.float32)
+        self.window = numpy.hanning(block).astype(numpy.float32)
+
+        freqs = numpy.fft.rfftfreq(block, 1.0 / PCM_RATE)
+        edges = numpy.geomspace(low, high, bands + 1)
+        # keep every band at least one bin wide at the low end
+        steps = numpy.arange(bands)
+        self.edges = numpy.searchsorted(freqs, edges[:-1]) - steps
+        self.edges = numpy.maximum.accumulate(self.edges) + steps
+        self.end = numpy.searchsorted(freqs, high)
+        widths = numpy.diff(numpy.append(self.edges, self.end)).clip(min=1)
+
+        # a full scale sine on both channels peaks at this magnitude, bands
+        # are averaged over their width and scaled against it
+        reference = (32768.0 * PCM_CHANNELS * self.window.sum() / 2) ** 2
+        self.scale = widths * reference
+
+        self.power = numpy.zeros(len(freqs))
+        self.bands = numpy.zeros(bands)
+        self.bars = numpy.zeros(bands, dtype=numpy.float32)
+
+    def analyse(self, raw):
+        pcm = numpy.frombuffer(raw, dtype="<i2").reshape(self.block, PCM_CHANNELS)
+        numpy.add(pcm[:, 0], pcm[:, 1], out=self.mono, dtype=numpy.float32)
+        numpy.multiply(self.mono, self.window, out=self.mono)
+
+        spectrum = numpy.fft.rfft(self.mono)
+        numpy.abs(spectrum, out=self.power)
+        numpy.square(self.power, out=self.power)
+        numpy.add.reduceat(self.power[: self.end], self.edges, out=self.bands)
+        numpy.divide(self.bands, self.scale, out=self.bands)
+
+        # bar height is 1 - dB / floor, clipped to 0..1
+        self.bands += 1e-12
+        numpy.log10(self.bands, out=self.bands)
+        numpy.multiply(self.bands, -10.0 / self.floor, out=self.bands)
+        self.bands += 1
+        numpy.clip(self.bands, 0, 1, out=self.bars)
+        return self.bars
+
+
+class SpectrumReader(threading.Thread):
+    """Reads PCM from a pipe and keeps the latest spectrum for the GUI"""
+
+    def __init__(self, path, bands, log):
+        super().__init__(name="spectrum", daemon=True)
+        self.path = path
+        self.log = log
+        self.analyser = SpectrumAnalyser(bands)
+        self.buffer = bytearray(self.analyser.block * PCM_CHANNELS * PCM_BYTES)
+        self.view = memoryview(self.buffer)
+        self.lock = threading.Lock()
+        self.bars = numpy.zeros(bands, dtype=numpy.float32)
+        self.fresh = False
+        self.running = True
+        self.blocks = 0
+
+    def _fill(self, f):
+        filled = 0
+        while filled < len(self.buffer):
+            n = f.readinto(self.view[filled:])
+            if not n:
+                return False
+            filled += n
+        return True
+
+    def pump(self, f):
+        while self.running and self._fill(f):
+            bars = self.analyser.analyse(self.buffer)
+            with self.lock:
+                # peak since the widget last looked, falloff is done there
+                numpy.maximum(bars, self.bars, out=self.bars)
+                self.fresh = True
+            self.blocks += 1
+
+    def latest(self):
+        with self.lock:
+            if not self.fresh:
+                return None
+            self.fresh = False
+            bars = self.bars.tolist()
+            self.bars.fill(0)
+            return bars
+
+    def run(self):
+        while self.running:
+            try:
+                # opening a FIFO blocks until shairport-sync starts playing
+                with open(self.path, "rb", buffering=0) as f:
+                    self.pump(f)
+            except OSError as e:
+                self.log.warning("spectrum pipe '%s': %s", self.path, e)
+                time.sleep(5)
+
+    def stop(self):
+        self.running = False
+
+
+class SpectrumWidget(QWidget):
+    """Paints the bars computed by a SpectrumReader at a capped frame rate"""
+
+    def __init__(self, reader, fps, parent=None):
+        super().__init__(parent)
+        self.reader = reader
+        self.bars = [0.0] * len(reader.bars)
+        self.color = QColor(210, 210, 210, 200)
+        self.setMinimumHeight(40)
+        self.setMaximumHeight(40)
+        self.setAttribute(Qt.WA_TranslucentBackground)
+
+        self.last = time.monotonic()
+        self.timer = QTimer(self)
+        self.timer.timeout.connect(self._poll)
+        self.timer.start(int(1000 / max(1, fps)))
+
+    def _poll(self):
+        now = time.monotonic()
+        keep = SPECTRUM_FALLOFF ** (now - self.last)
+        self.last = now
+
+        # the pipe just blocks while paused, so bars have to fall on the
+        # timer rather than when audio arrives
+        bars = self.reader.latest()
+        if bars is None:
+            if not any(self.bars):
+                return
+            bars = [0.0] * len(self.bars)
+        fallen = [old * keep if old * keep > 0.01 else 0.0 for old in self.bars]
+        self.bars = [max(level, old) for level, old in zip(bars, fallen)]
+        self.update()
+
+    def paintEvent(self, event):
+        painter = QPainter(self)
+        width = self.width() / len(self.bars)
+        height = self.height()
+        gap = 2 if width > 4 else 0
+        for n, level in enumerate(self.bars):
+            h = int(level * height)
+            if h > 0:
+                painter.fillRect(
+                    int(n * width) + gap // 2,
+                    height - h,
+                    max(1, int(width) - gap),
+                    h,
+                    self.color,
+                )
+        painter.end()
+
+
+def benchmark_spectrum(seconds, bands, fps):
+    frames = int(seconds * PCM_RATE)
+    t = numpy.arange(frames) / PCM_RATE
+    # a sweep plus noise so every band sees some energy
+    signal = 0.4 * numpy.sin(2 * math.pi * 100 * (200 ** (t / seconds)) * t)
+    signal += 0.05 * numpy.random.default_rng(0).standard_normal(frames)
+    pcm = (numpy.repeat(signal[:, None], PCM_CHANNELS, axis=1) * 32767).astype("<i2")
+
+    reader = SpectrumReader(None, bands, logging.getLogger("shairport-display"))
+    source = io.BytesIO(pcm.tobytes())
+    cpu = time.process_time()
+    wall = time.perf_counter()
+    reader.pump(source)
+    cpu = time.process_time() - cpu
+    wall = time.perf_counter() - wall
+
+    block = reader.analyser.block
+    print(
+        "audio:             %.1f s, %d blocks of %d frames"
+        % (seconds, reader.blocks, block)
+    )
+    print("cpu per block:     %.3f ms" % (cpu / reader.blocks * 1000))
+    print("wall per block:    %.3f ms" % (wall / reader.blocks * 1000))
+    print("reader cpu load:   %.2f %% of one core" % (cpu / seconds * 100))
+
+    # the GUI thread side: a poll with new bars and a paint into a pixmap per
+    # frame, on the offscreen platform unless one is set
+    os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+    app = QApplication(sys.argv[:1])
+    widget = SpectrumWidget(reader, fps)
+    widget.timer.stop()
+    widget.resize(400, widget.height())
+    target = QPixmap(widget.size())
+    levels = numpy.random.default_rng(1).random((64, bands))
+
+    repaints = int(seconds * fps)
+    gui = 0.0
+    for n in range(repaints):
+        with reader.lock:
+            reader.bars[:] = levels[n % len(levels)]
+            reader.fresh = True
+        begin = time.process_time()
+        widget._poll()
+        target.fill(QColor("black"))
+        widget.render(target)
+        gui += time.process_time() - begin
+    del app
+
+    print("cpu per repaint:   %.3f ms" % (gui / repaints * 1000))
+    print(
+        "gui cpu load:      %.2f %% of one core at %d fps" % (gui / seconds * 100, fps)
+    )
+    print("total cpu load:    %.2f %% of one core" % ((cpu + gui) / seconds * 100))
+
+
+class MetadataPipeParser:
+    """Incremental parser for shairport-sync's metadata pipe XML items
+
+    Each item looks like
+      <item><type>636f7265</type><code>6d696e6d</code><length>11</length>
+      <data encoding="base64">...</data></item>
+    with type and code as hex encoded four character codes. Data may be split
+    over any number of reads, feed() returns the items completed so far.
+    """
+
+    ITEM_END = b"</item>"
+    HEADER = re.compile(
+        rb"<type>([0-9a-fA-F]{8})</type>\s*<code>([0-9a-fA-F]{8})</code>"
+        rb"\s*<length>(\d+)</length>"
+    )
+    DATA = re.compile(rb"<data encoding=\"base64\">(.*)</data>", re.DOTALL)
+
+    def __init__(self, log):
+        self.log = log
+        self.buffer = bytearray()
+        self.scanned = 0
+
+    def feed(self, chunk):
+        self.buffer += chunk
+        items = []
+        start = 0
+        while True:
+            # do not rescan base64 we already know holds no end tag
+            end = self.buffer.find(
+                self.ITEM_END, max(start, self.scanned - len(self.ITEM_END))
+            )
+            if end < 0:
+                break
+            item = self._parse(bytes(self.buffer[start:end]))
+            if item is not None:
+                items.append(item)
+            start = end + len(self.ITEM_END)
+            self.scanned = start
+        del self.buffer[:start]
+        self.scanned = len(self.buffer)
+        return items
+
+    def _parse(self, item):
+        header = self.HEADER.search(item)
+        if header is None:
+            return None
+        kind = bytes.fromhex(header.group(1).decode()).decode("latin-1")
+        code = bytes.fromhex(header.group(2).decode()).decode("latin-1")
+        payload = b""
+        if int(header.group(3)):
+            data = self.DATA.search(item, header.end())
+            if data is not None:
+                try:
+                    payload = binascii.a2b_base64(data.group(1))
+                except binascii.Error as e:
+                    self.log.warning("skipping %s %s item: %s", kind, code, e)
+                    return None
+        return kind, code, payload
+
+
+class MetadataPipeReader(QObject):
+    """Reads shairport-sync's metadata pipe and emits D-Bus style changes
+
+    Items are translated into the same property dictionaries that arrive in
+    PropertiesChanged, so the client handles both backends in
+    handlePropertyChanges. Cover art is passed along as bytes in
+    mpris:artUrl instead of a temp file name.
+    """
+
+    changed = pyqtSignal(str, object)
+
+    INTERFACE = "org.gnome.ShairportSync"
+    STATES = {"pbeg": "Playing", "prsm": "Playing", "pfls": "Paused", "pend": "Stopped"}
+
+    def __init__(self, path, log):
+        super().__init__()
+        self.path = path
+        self.log = log
+        self.parser = MetadataPipeParser(log)
+        self.buffer = bytearray(65536)
+        self.view = memoryview(self.buffer)
+        self.metadata = {}
+        self.bundle = None
+        self.running = True
+        self.thread = threading.Thread(
+            target=self._run, name="metadata-pipe", daemon=True
+        )
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+
+    def _run(self):
+        while self.running:
+            try:
+                with open(self.path, "rb", buffering=0) as f:
+                    self.log.info("reading metadata from '%s'", self.path)
+                    self.pump(f)
+            except OSError as e:
+                self.log.warning("metadata pipe '%s': %s", self.path, e)
+                time.sleep(5)
+
+    def pump(self, f):
+        while self.running:
+            n = f.readinto(self.view)
+            if not n:
+                return
+            for kind, code, payload in self.parser.feed(self.view[:n]):
+                self.handleItem(kind, code, payload)
+
+    def _emit(self, data):
+        self.changed.emit(self.INTERFACE, data)
+
+    def handleItem(self, kind, code, payload):
+        if kind == "core":
+            if self.bundle is None:
+                return
+            if code == "minm":
+                self.bundle["xesam:title"] = payload.decode("utf-8", "replace")
+            elif code == "asar":
+                self.bundle["xesam:artist"] = [payload.decode("utf-8", "replace")]
+            elif code == "asal":
+                self.bundle["xesam:album"] = payload.decode("utf-8", "replace")
+            elif code == "astm" and len(payload) == 4:
+                # milliseconds, D-Bus uses microseconds
+                self.bundle["mpris:length"] = int.from_bytes(payload, "big") * 1000
+            elif code == "asdk" and len(payload) == 1:
+                self.bundle["sps:songdatakind"] = payload[0]
+            return
+
+        if kind != "ssnc":
+            return
+
+        if code == "mdst":
+            self.bundle = {}
+        elif code == "mden" and self.bundle is not None:
+            same = all(
+                self.bundle.get(k) == self.metadata.get(k)
+                for k in ("xesam:title", "xesam:artist", "xesam:album")
+            )
+            if same and "mpris:artUrl" in self.metadata:
+                # art follows the bundle, keep it for a re-sent bundle
+                self.bundle["mpris:artUrl"] = self.metadata["mpris:artUrl"]
+            self.metadata = self.bundle
+            self.bundle = None
+            self._emit({"Metadata": dict(self.metadata)})
+        elif code == "PICT":
+            # a truncated or unsupported image would fail in the handlers
+            if payload and QImage.fromData(payload).isNull():
+                self.log.warning("skipping PICT item, not an image")
+                return
+            self.metadata["mpris:artUrl"] = payload
+            self._emit({"Metadata": dict(self.metadata)})
+        elif code == "prgr":
+            progress = payload.decode("ascii", "replace")
+            try:
+                if len([int(x) for x in progress.split("/")]) != 3:
+                    raise ValueError
+            except ValueError:
+                self.log.warning("bad prgr item %r", payload)
+                return
+            self._emit({"ProgressString": progress})
+        elif code == "pvol":
+            try:
+                volume = float(payload.decode("ascii").split(",")[0])
+            except (ValueError, UnicodeDecodeError):
+                self.log.warning("bad pvol item %r", payload)
+                return
+            # -144 is mute, the slider stops at -30
+            self._emit({"AirplayVolume": max(volume, -30.0)})
+        elif code in self.STATES:
+            self._emit({"PlayerState": self.STATES[code]})
+        elif code == "snam":
+            self._emit({"ClientName": payload.decode("utf-8", "replace")})
+        elif code == "svna":
+            self._emit({"ServiceName": payload.decode("utf-8", "replace")})
+
 
 class ShairportSyncClient(QApplication):
-    def __init__(self, argv):
+    def __init__(self, argv, args):
+
+        if args.replay:
+            # replay runs headless unless a platform was asked for
+            os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
 
         super().__init__(argv)
 
@@ -70,10 +978,26 @@ class ShairportSyncClient(QApplication):
         self.DisplayCleared = True
 
         self.properties_changed = None
+        self._bus = None
+        self.recorder = None
+        self.polled = None
+        self.replayer = None
+        self.history = None
+        self.nowplaying = None
+        self.historystale = False
+        self.spectrum = None
+        self.pipe = None
+        self.backend = args.backend
 
         self._setup_loop()
-        self._setup_bus()
-        self._setup_signals()
+        if args.replay:
+            pass
+        elif self.backend == "pipe":
+            # D-Bus is only needed for the remote control buttons here
+            self._setup_bus(required=False)
+        else:
+            self._setup_bus()
+            self._setup_signals()
 
         self.length = 0
         self.progress = 0
@@ -99,17 +1023,8 @@ class ShairportSyncClient(QApplication):
             print("Cannot find shairport-display.ui or syntax error in ui file")
             exit(1)
 
-        # get command line args
-        parser = argparse.ArgumentParser(description="Shairport Sync Display")
-        parser.add_argument(
-            "--config",
-            choices=["desktop", "raspberrypiofficial7inchscreen"],
-            default="raspberrypiofficial7inchscreen",
-        )
-        args = parser.parse_args()
-
         self.desktopmode = False
-        if args.config.lower() == "desktop":
+        if args.config.lower() == "desktop" or args.replay:
             self.desktopmode = True
 
         if self.desktopmode is False:
@@ -172,6 +1087,11 @@ class ShairportSyncClient(QApplication):
         self.Vol = self.window.findChild(QSlider, "Vol")
         self.Vol.valueChanged.connect(self.vol)
 
+        if self._bus is None:
+            self.log.info("no D-Bus remote control, buttons disabled")
+            for control in (self.B1, self.B2, self.B3, self.Vol):
+                control.setEnabled(False)
+
         self.Art = self.window.findChild(QLabel, "CoverArt")
 
         self.Title = self.window.findChild(QLabel, "Title")
@@ -197,17 +1117,47 @@ class ShairportSyncClient(QApplication):
         # self.animation = QPropertyAnimation(self.ProgressBar, b"value")
         self.ProgressBar.setRange(0, 100)
 
+        if args.spectrum:
+            if numpy is None:
+                self.log.error("the spectrum needs numpy: apt install python3-numpy")
+            else:
+                self.spectrum = SpectrumReader(
+                    args.spectrum, args.spectrum_bands, self.log
+                )
+                self.Spectrum = SpectrumWidget(self.spectrum, args.spectrum_fps)
+                self.window.findChild(QVBoxLayout, "verticalLayout_3").addWidget(
+                    self.Spectrum
+                )
+                self.spectrum.start()
+
         self.Remaining = self.window.findChild(QLabel, "Remaining")
         self.Remaining.setFont(QFont("Montserrat", 10, QFont.Normal))
         self.Elapsed = self.window.findChild(QLabel, "Elapsed")
         self.Elapsed.setFont(QFont("Montserrat", 10, QFont.Normal))
 
+        if args.record:
+            self.recorder = TraceRecorder(args.record, self.log)
+
+        if args.history:
+            self.history = PlayHistory(args.history, self.log, args.history_flush)
+
         self._clear_display()
         self._initialize_display()
         self._start_timer()
 
         self.window.destroyed.connect(self.quit)
 
+        if self.backend == "pipe" and not args.replay:
+            self.pipe = MetadataPipeReader(args.metadata_pipe, self.log)
+            self.pipe.changed.connect(self.handlePipeChanges)
+            self.pipe.start()
+
+        if args.replay:
+            self.replayer = TraceReplayer(
+                self, args.replay, args.replay_speed, args.replay_loops
+            )
+            self.replayer.start()
+
     def rotate(self, input, d):
         Lfirst = " .. " + input[0:d]
         Lsecond = input[d:]
@@ -229,7 +1179,7 @@ class ShairportSyncClient(QApplication):
             self.Album.setMaximumWidth(int(size.width() / 2))
 
         if self.ArtPath is not None:
-            pixmap = QPixmap(self.ArtPath)
+            pixmap = self.art_pixmap(self.ArtPath)
             if pixmap.width() >= pixmap.height():
                 self.Art.setPixmap(
                     pixmap.scaledToWidth(
@@ -291,7 +1241,7 @@ class ShairportSyncClient(QApplication):
 
     def _tickEvent(self):
 
-        if (self.incr % 10) == 0:
+        if self.backend == "dbus" and self._bus is not None and (self.incr % 10) == 0:
 
             if self._get_sps_info(".RemoteControl", "Available") != 0:
                 self.clientname = self._get_sps_info(".RemoteControl", "ClientName")
@@ -309,6 +1259,17 @@ class ShairportSyncClient(QApplication):
 
                 s = self._get_sps_info(".RemoteControl", "PlayerState")
                 self._fixplaypause(s)
+
+                # polled state never comes through handlePropertyChanges
+                polled = {
+                    "ClientName": self.clientname,
+                    "ServiceName": self.servicename,
+                    "PlayerState": s,
+                }
+                polled = {k: v for k, v in polled.items() if v is not None}
+                if polled != self.polled:
+                    self.polled = polled
+                    self._record(polled)
             else:
                 self.log.debug("Remote control is not available")
                 # self._clear_display()
@@ -359,25 +1320,51 @@ class ShairportSyncClient(QApplication):
 
     def quit(self, *args):
         self.log.info("Stopping application")
-        self.properties_changed.remove()
+        if self.properties_changed is not None:
+            self.properties_changed.remove()
+        if self.recorder is not None:
+            self.recorder.close()
+            self.recorder = None
+        if self.pipe is not None:
+            self.pipe.stop()
+        if self.spectrum is not None:
+            self.spectrum.stop()
+        if self.history is not None:
+            self._history_end()
+            self.history.close()
+            self.history = None
         self._set_backlight(False)
         QApplication.quit()
 
     def _setup_loop(self):
         self._loop = dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
 
-    def _setup_bus(self):
+    def _setup_bus(self, required=True):
 
         dbus.set_default_main_loop(self._loop)
 
-        if dbus.SystemBus().name_has_owner("org.gnome.ShairportSync"):
-            self.log.debug("shairport-sync dbus service is running on the system bus")
-            self._bus = dbus.SystemBus()
+        try:
+            if dbus.SystemBus().name_has_owner("org.gnome.ShairportSync"):
+                self.log.debug(
+                    "shairport-sync dbus service is running on the system bus"
+                )
+                self._bus = dbus.SystemBus()
+                return
+
+            if dbus.SessionBus().name_has_owner("org.gnome.ShairportSync"):
+                self.log.debug(
+                    "shairport-sync dbus service is running on the session bus"
+                )
+                self._bus = dbus.SessionBus()
+                return
+        except dbus.exceptions.DBusException as e:
+            if required:
+                raise
+            self.log.warning("cannot connect to dbus: %s", e)
             return
 
-        if dbus.SessionBus().name_has_owner("org.gnome.ShairportSync"):
-            self.log.debug("shairport-sync dbus service is running on the session bus")
-            self._bus = dbus.SessionBus()
+        if not required:
+            self.log.warning("shairport-sync dbus service is not running")
             return
 
         self.log.error("shairport-sync dbus service is not running")
@@ -414,6 +1401,10 @@ class ShairportSyncClient(QApplication):
             except PermissionError:
                 self.log.warning("incorrect permissions for '" + self.backlight + "'")
 
+    def _record(self, data):
+        if self.recorder is not None:
+            self.recorder.record("org.gnome.ShairportSync.RemoteControl", data)
+
     def _initialize_display(self):
 
         self._set_backlight(True)
@@ -423,6 +1414,10 @@ class ShairportSyncClient(QApplication):
         for tl in QApplication.topLevelWidgets():
             tl.setVisible(True)
 
+        if self._bus is None or self.backend != "dbus":
+            # replaying a trace or reading the metadata pipe, nothing to ask
+            return
+
         self.log.info("Get initial volume from player.")
         initialVolume = self._get_sps_info(".RemoteControl", "AirplayVolume")
         if initialVolume is None:
@@ -437,6 +1432,8 @@ class ShairportSyncClient(QApplication):
             self.log.warning("shairport-sync is not running on the bus")
             exit(1)
         else:
+            # a trace started mid-track needs the state it started from
+            self._record({"AirplayVolume": initialVolume, "Metadata": initialMetadata})
             self.handleMetadata(initialMetadata)
 
     def _setup_signals(self):
@@ -448,7 +1445,16 @@ class ShairportSyncClient(QApplication):
             member_keyword="signal",
         )
 
+    def art_pixmap(self, art):
+        if isinstance(art, bytes):
+            pixmap = QPixmap()
+            pixmap.loadFromData(art)
+            return pixmap
+        return QPixmap(art)
+
     def average_image_color(self, filename):
+        if isinstance(filename, bytes):
+            filename = io.BytesIO(filename)
         i = Image.open(filename)
         h = i.histogram()
 
@@ -501,7 +1507,7 @@ class ShairportSyncClient(QApplication):
                         self.log.debug(
                             "%s IS in self.metadata self.metadata[art]=%s",
                             key,
-                            self.metadata["art"],
+                            loggable(self.metadata["art"]),
                         )
                     self.log.debug("metadata changed 1 %s", key)
                     return True
@@ -514,13 +1520,18 @@ class ShairportSyncClient(QApplication):
 
     def _set_metadata(self, metadata):
 
+        self.historystale = False
         if not self._meta_changed(metadata):
+            if self.nowplaying is None and self.playing:
+                # the same track playing again after Stopped
+                self._history_track(metadata)
             return
 
         for key in metadata:
-            self.log.info("metadata %s: %s", key, metadata[key])
+            self.log.info("metadata %s: %s", key, loggable(metadata[key]))
 
         self.metadata = metadata
+        self._history_track(metadata)
 
         self.Title.setText(metadata["title"])
         self.Artist.setText(metadata["artist"])
@@ -566,7 +1577,7 @@ class ShairportSyncClient(QApplication):
                 + ");}"
             )
 
-            pixmap = QPixmap(self.ArtPath)
+            pixmap = self.art_pixmap(self.ArtPath)
             if pixmap.width() >= pixmap.height():
                 pixmap = pixmap.scaledToWidth(
                     int((size.width() / 2) - 100), Qt.SmoothTransformation
@@ -600,6 +1611,66 @@ class ShairportSyncClient(QApplication):
             shadow.setColor(QColor(0, 0, 0, 180))
             self.Art.setGraphicsEffect(shadow)
 
+    def _art_digest(self, art):
+        if not art:
+            return ""
+        try:
+            return art_digest(art)
+        except OSError:
+            self.log.warning("cannot read art '%s' for play history", art)
+            return ""
+
+    def _history_track(self, metadata):
+        if self.history is None:
+            return
+
+        if self.nowplaying is not None and all(
+            self.nowplaying[k] == metadata[k] for k in ("title", "artist", "album")
+        ):
+            # same track, art or length usually arrive a little later
+            if metadata["art"]:
+                self.nowplaying["art"] = self._art_digest(metadata["art"])
+            if metadata["length"]:
+                self.nowplaying["length"] = round(metadata["length"] / 1000000)
+            return
+
+        self._history_end()
+        if not metadata["title"]:
+            return
+
+        now = time.time()
+        self.nowplaying = {
+            "started": now,
+            "since": now if self.playing else None,
+            "played": 0.0,
+            "title": metadata["title"],
+            "artist": metadata["artist"],
+            "album": metadata["album"],
+            "length": round(metadata["length"] / 1000000),
+            "client": str(self.clientname or ""),
+            "art": self._art_digest(metadata["art"]),
+        }
+
+    def _history_playing(self, playing):
+        if self.history is None or self.nowplaying is None:
+            return
+        now = time.time()
+        if playing and self.nowplaying["since"] is None:
+            self.nowplaying["since"] = now
+        elif not playing and self.nowplaying["since"] is not None:
+            self.nowplaying["played"] += now - self.nowplaying["since"]
+            self.nowplaying["since"] = None
+
+    def _history_end(self):
+        if self.history is None or self.nowplaying is None:
+            return
+        self._history_playing(False)
+        play = self.nowplaying
+        self.nowplaying = None
+        del play["since"]
+        play["ended"] = time.time()
+        self.history.add(play)
+
     def _stop_timer(self):
         if self.timer is not None:
             self.log.debug("stopping timer")
@@ -634,16 +1705,28 @@ class ShairportSyncClient(QApplication):
                 self.log.debug("SET PAUSE")
                 self.B2.setIcon(QIcon("pause.png"))
                 self.playing = True
+                if (
+                    self.nowplaying is None
+                    and not self.historystale
+                    and self.metadata.get("title")
+                ):
+                    # metadata since Stopped confirmed the same track again
+                    self._history_track(self.metadata)
+                self._history_playing(True)
         elif state == "Paused":
             if self.playing:
                 # self._stop_timer()
                 self.log.debug("SET PLAY")
                 self.B2.setIcon(QIcon("play.png"))
                 self.playing = False
+                self._history_playing(False)
         elif state == "Stopped":
             self._clear_display()
             self._stop_timer()
             self.playing = False
+            self._history_end()
+            # until metadata arrives self.metadata may be the last session's
+            self.historystale = True
 
     def handleAirplayVolume(self, nv):
         bb = self.Vol.blockSignals(True)
@@ -699,18 +1782,29 @@ class ShairportSyncClient(QApplication):
                     metadata[f] = ", ".join(metadata_from_dbus[t])
                 else:
                     metadata[f] = metadata_from_dbus[t]
-                self.log.debug("set %s to %s", f, metadata[f])
+                self.log.debug("set %s to %s", f, loggable(metadata[f]))
             else:
                 if f == "length":
                     metadata[f] = 0
                 else:
                     metadata[f] = ""
-        metadata["art"] = metadata["art"].split("://")[-1]
+        if isinstance(metadata["art"], str):
+            metadata["art"] = metadata["art"].split("://")[-1]
         self._set_metadata(metadata)
 
+    def handlePipeChanges(self, interface, data):
+        # an exception escaping a Qt slot aborts the process, where dbus
+        # only logs exceptions from signal handlers
+        try:
+            self.handlePropertyChanges(interface, data)
+        except Exception:
+            self.log.exception("failed to handle metadata pipe change")
+
     def handlePropertyChanges(self, *args, **kwargs):
         interface = args[0]
         data = args[1]
+        if self.recorder is not None:
+            self.recorder.record(interface, data)
         # self.log.debug("Received signal for %s", interface)
         if "AirplayVolume" in data:
             self.log.debug("airplay volume property change")
@@ -725,6 +1819,12 @@ class ShairportSyncClient(QApplication):
             self.log.debug("playerstate signal")
             state = data["PlayerState"]
             self._fixplaypause(state)
+        if "ClientName" in data:
+            self.clientname = data["ClientName"]
+            self.Client.setText(self.clientname)
+        if "ServiceName" in data:
+            self.servicename = data["ServiceName"]
+            self.Service.setText(self.servicename)
 
         if "Active" in data:
             if data["Active"]:
@@ -737,8 +1837,22 @@ class ShairportSyncClient(QApplication):
 
 if __name__ == "__main__":
 
-    client = ShairportSyncClient(sys.argv)
+    args = parse_args()
+    if args.history_bench:
+        logging.basicConfig(level=logging.INFO)
+        benchmark_history(args.history_bench)
+        sys.exit(0)
+    if args.spectrum_bench:
+        if numpy is None:
+            print("the spectrum needs numpy: apt install python3-numpy")
+            sys.exit(1)
+        benchmark_spectrum(args.spectrum_bench, args.spectrum_bands, args.spectrum_fps)
+        sys.exit(0)
+
+    client = ShairportSyncClient(sys.argv, args)
     signal.signal(signal.SIGINT, lambda *args: client.quit())
+    # systemd stops the service with SIGTERM, quit() flushes the play history
+    signal.signal(signal.SIGTERM, lambda *args: client.quit())
 
     client.startTimer(500)
 